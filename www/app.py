@@ -5,11 +5,14 @@ from datetime import datetime
 
 from aiohttp import web
 
+import orm, tracing
 
 
 HOST = '127.0.0.1'
 PORT = 9000
 
+DB = dict(user='www-data', password='www-data', db='awesome')
+
 routes = web.RouteTableDef()
 
 # Handling request to app by routers in a decorator way
@@ -22,13 +25,31 @@ async def handler(request):
     return web.Response(body=b'<h1>Awesome</h1>', content_type='text/html')
 
 
-def init():
-    app = web.Application()
+# on_startup runs before the server starts listening, so the pool is warm for the first request
+async def init_db(app):
+    await orm.create_pool(asyncio.get_event_loop(), **DB)
+
+async def close_db(app):
+    await orm.close_pool()
+
+
+def create_app():
+    # every request is traced, the totals go out as a Server-Timing header
+    app = web.Application(middlewares=[tracing.trace_middleware])
+    app.on_response_prepare.append(tracing.on_response_prepare)
     app.add_routes(routes)
+    return app
+
+
+def init():
+    app = create_app()
+    app.on_startup.append(init_db)
+    app.on_cleanup.append(close_db)
     logging.info('Server started at http://{}:{}'.format(HOST, PORT))
     web.run_app(app, host=HOST, port=PORT)
 
-init()
+if __name__ == '__main__':
+    init()
 
 # Another way of handling request
 
@@ -0,0 +1,7 @@
+-- Blog.comment_count (CounterField), maintained by Comment.save() / update() / remove().
+-- Run once before deploying, Blog.find / findAll / save select and insert this column.
+
+alter table blogs add comment_count bigint not null default 0;
+
+-- backfill the counts of existing blogs
+update blogs b set comment_count = (select count(*) from comments c where c.blog_id = b.id);
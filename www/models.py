@@ -6,7 +6,7 @@ __author__ = 'Michael Liao'
 
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, CounterField
 
 def next_id():
     # used for creating primary key
@@ -33,10 +33,13 @@ class Blog(Model):
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
     content = TextField()
+    comment_count = CounterField()
     created_at = FloatField(default=time.time)
 
 class Comment(Model):
     __table__ = 'comments'
+    # Blog.comment_count is updated by save() / update() / remove(), see migrate_blog_comment_count.sql
+    __counters__ = [('blog_id', Blog, 'comment_count')]
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
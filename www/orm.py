@@ -1,6 +1,9 @@
-import asyncio, logging
+import asyncio, logging, time
 import aiomysql
 
+from pool import PoolManager
+from tracing import record_query
+
 
 
 def log(sql, args=()):
@@ -9,8 +12,9 @@ def log(sql, args=()):
 
 async def create_pool(loop, **kw):
     # creating connection pools
+    # maxsize grows up to max_limit under load, see pool.PoolManager for the other knobs
     logging.info('create database connection pool...')
-    global __pool
+    global __pool, __manager
     __pool = await aiomysql.create_pool(
             host=kw.get('host', 'localhost'),
             port=kw.get('port', 3306),
@@ -23,26 +27,52 @@ async def create_pool(loop, **kw):
             minsize=kw.get('minsize', 1),
             loop=loop
     )
+    __manager = PoolManager(__pool,
+            minsize=kw.get('minsize', 1),
+            maxsize=kw.get('maxsize', 10),
+            max_limit=kw.get('max_limit', 50),
+            warm=kw.get('warm', None),
+            max_age=kw.get('max_age', 3600),
+            idle_timeout=kw.get('idle_timeout', 300),
+            ping_interval=kw.get('ping_interval', 30)
+    )
+    # open the connections now, before the server accepts requests
+    await __manager.warm_up()
+    __manager.start()
+
+async def close_pool():
+    logging.info('close database connection pool...')
+    await __manager.close()
 
 async def select(sql, args, size=None):
     # SQL: SELECT
     log(sql, args)
     global __pool
+    t0 = time.perf_counter()
     async with __pool.acquire() as conn: # __pool.get() in Liao's code
-        async with conn.cursor(aiomysql.DictCursor) as cur: # returns results as dictionary
-            # SQL占位符：？，MySQL占位符： %s
-            await cur.execute(sql.replace('?', '%s'), args or ())
-            if size:
-                rs = await cur.fetchmany(size)
-            else:
-                rs = await cur.fetchall()
+        t1 = time.perf_counter()
+        __manager.observe(t1 - t0, conn)
+        rs = []
+        try:
+            async with conn.cursor(aiomysql.DictCursor) as cur: # returns results as dictionary
+                # SQL占位符：？，MySQL占位符： %s
+                await cur.execute(sql.replace('?', '%s'), args or ())
+                if size:
+                    rs = await cur.fetchmany(size)
+                else:
+                    rs = await cur.fetchall()
+        finally:
+            record_query(sql, time.perf_counter() - t1, t1 - t0, len(rs))
         logging.info('rows returned: %s' % len(rs))
         return rs
 
 async def execute(sql, args, autocommit=True):
     # SQL: INSERT, UPDATE, DELETE
     log(sql)
+    t0 = time.perf_counter()
     async with __pool.acquire() as conn:
+        t1 = time.perf_counter()
+        __manager.observe(t1 - t0, conn)
         if not autocommit:
             await conn.begin()
         try:
@@ -55,8 +85,56 @@ async def execute(sql, args, autocommit=True):
             if not autocommit:
                 await conn.rollback()
             raise
+        finally:
+            record_query(sql, time.perf_counter() - t1, t1 - t0)
         return affected
 
+class Transaction(object):
+    '''
+    Statements run on the connection of transaction(), logged and traced like select() / execute().
+    '''
+
+    def __init__(self, cur, pool_wait):
+        self._cur = cur
+        self._pool_wait = pool_wait # charged to the first statement only
+
+    async def _run(self, sql, args, fetch):
+        log(sql, args)
+        t = time.perf_counter()
+        rs = []
+        try:
+            await self._cur.execute(sql.replace('?', '%s'), args or ())
+            if fetch:
+                rs = await self._cur.fetchall()
+        finally:
+            record_query(sql, time.perf_counter() - t, self._pool_wait, len(rs))
+            self._pool_wait = 0.0
+        return rs if fetch else self._cur.rowcount
+
+    async def select(self, sql, args):
+        return await self._run(sql, args, True)
+
+    async def execute(self, sql, args):
+        # returns affected rows
+        return await self._run(sql, args, False)
+
+async def transaction(fn):
+    # SQL: run `await fn(tx)` with a Transaction on one connection,
+    # commit when it returns, rollback when it raises; returns what fn returns
+    t0 = time.perf_counter()
+    async with __pool.acquire() as conn:
+        t1 = time.perf_counter()
+        __manager.observe(t1 - t0, conn)
+        await conn.begin()
+        try:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                r = await fn(Transaction(cur, t1 - t0))
+            await conn.commit()
+        except BaseException as e:
+            await conn.rollback()
+            raise
+        return r
+
 def create_args_string(num):
     L = []
     for n in range(num):
@@ -108,6 +186,16 @@ class TextField(Field):
         super().__init__(name, 'text', False, default)
 
 
+class CounterField(IntegerField):
+    '''
+    Denormalized count maintained by the ORM (see Model.__counters__).
+    It is written on insert but never by update(), so a stale object can not overwrite it.
+    '''
+
+    def __init__(self, name=None, default=0):
+        super().__init__(name, False, default)
+
+
 class ModelMetaclass(type):
 
     def __new__(cls, name, bases, attrs):
@@ -133,7 +221,7 @@ class ModelMetaclass(type):
         if not primaryKey:
             raise StandardError('Primary key not found.')
 
-        if k in mappings.keys():
+        for k in mappings.keys():
             attrs.pop(k)
 
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
@@ -145,8 +233,24 @@ class ModelMetaclass(type):
         attrs['__fields__'] = fields # 主键以外的属性名
         attrs['__select__'] = 'SELECT `%s`, %s FROM `%s`' % (primaryKey, ', '.join(escaped_fields), tableName)
         attrs['__insert__'] = 'INSERT INTO `%s` (%s, `%s`) VALUES (%s)' % (tableName, ', '.join(escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
-        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
+        update_fields = [f for f in fields if not isinstance(mappings[f], CounterField)]
+        attrs['__update_fields__'] = update_fields
+        attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(map(lambda f: '`%s`=?' % (mappings.get(f).name or f), update_fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (tableName, primaryKey)
+
+        # __counters__ = [(foreign key field, parent Model, CounterField name of parent)]
+        # e.g. Comment: [('blog_id', Blog, 'comment_count')]
+        counters = []
+        for fk, parent, counter in attrs.get('__counters__', ()):
+            if fk not in mappings or not isinstance(parent.__mappings__.get(counter), CounterField):
+                raise ValueError('Invalid counter: %s -> %s.%s' % (fk, parent.__name__, counter))
+            bump = 'update `%s` set `%s`=`%s`+? where `%s`=' % (parent.__table__, counter, counter, parent.__primary_key__)
+            # second form finds the parent through the row's foreign key in the database, used by remove()
+            counters.append((fk, bump + '?', bump + '(select `%s` from `%s` where `%s`=?)' % (fk, tableName, primaryKey)))
+        attrs['__counters__'] = counters
+        # foreign keys as stored, locked until the end of the transaction, used by update()
+        if counters:
+            attrs['__select_counter_keys__'] = 'select %s from `%s` where `%s`=? for update' % (', '.join('`%s`' % c[0] for c in counters), tableName, primaryKey)
         
 
         return type.__new__(cls, name, bases, attrs)
@@ -163,7 +267,7 @@ class Model(dict, metaclass=ModelMetaclass):
         try:
             return self[k]
         except KeyError:
-            raise AttributeError(r"'Model' object has no attribute '%s'" % key)
+            raise AttributeError(r"'Model' object has no attribute '%s'" % k)
 
     def __setattr__(self, k, v):
 
@@ -223,6 +327,25 @@ class Model(dict, metaclass=ModelMetaclass):
             return None
         return rs[0]['_num_']
 
+    @classmethod
+    async def countBy(cls, field, keys, where=None, args=None):
+        ' count rows for many values of field in one GROUP BY query, returns {key: count}. '
+        # 调用示例：
+        # counts = await Comment.countBy('blog_id', [b.id for b in blogs])
+        keys = list(keys)
+        if not keys:
+            return dict()
+        sql = ['select `%s` _key_, count(*) _num_ from `%s` where `%s` in (%s)' % (field, cls.__table__, field, create_args_string(len(keys)))]
+        args = keys + list(args or [])
+        if where:
+            sql.append('and (%s)' % where)
+        sql.append('group by `%s`' % field)
+        rs = await select(' '.join(sql), args)
+        counts = dict.fromkeys(keys, 0)
+        for r in rs:
+            counts[r['_key_']] = r['_num_']
+        return counts
+
     @classmethod
     async def find(cls, pk):
         ' find object by primary key. '
@@ -237,21 +360,60 @@ class Model(dict, metaclass=ModelMetaclass):
         # await user.save()
         args = list(map(self.getValueOrDefault, self.__fields__))
         args.append(self.getValueOrDefault(self.__primary_key__))
-        rows = await execute(self.__insert__, args)
+        if self.__counters__:
+            # keep the parents' counters in the same transaction as the insert
+            async def run(tx):
+                rows = await tx.execute(self.__insert__, args)
+                if rows == 1:
+                    for fk, sql, _ in self.__counters__:
+                        if self.getValue(fk) is not None:
+                            await tx.execute(sql, [1, self.getValue(fk)])
+                return rows
+            rows = await transaction(run)
+        else:
+            rows = await execute(self.__insert__, args)
         if rows != 1:
             logging.warn('failded to insert record: affected rows: %s' % rows)
 
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        args = list(map(self.getValue, self.__update_fields__))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        if self.__counters__:
+            # the foreign key may move the row to another parent: -1 on the parent
+            # stored in the database, +1 on the new one, only when it changed
+            async def run(tx):
+                rs = await tx.select(self.__select_counter_keys__, [self.getValue(self.__primary_key__)])
+                moved = []
+                if rs:
+                    for fk, sql, _ in self.__counters__:
+                        if rs[0][fk] != self.getValue(fk):
+                            moved.append((sql, rs[0][fk], self.getValue(fk)))
+                for sql, old, new in moved:
+                    if old is not None:
+                        await tx.execute(sql, [-1, old])
+                rows = await tx.execute(self.__update__, args)
+                for sql, old, new in moved:
+                    if new is not None:
+                        await tx.execute(sql, [1, new])
+                return rows
+            rows = await transaction(run)
+        else:
+            rows = await execute(self.__update__, args)
         if rows != 1:
             logging.warn('failed to update by primary key: affect rows: %s' % rows)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
-        if row != 1:
+        if self.__counters__:
+            # decrement the parent the row has in the database, not the one in memory
+            async def run(tx):
+                for _, _, sql in self.__counters__:
+                    await tx.execute(sql, [-1, args[0]])
+                return await tx.execute(self.__delete__, args)
+            rows = await transaction(run)
+        else:
+            rows = await execute(self.__delete__, args)
+        if rows != 1:
             logging.warn('failed to remove by primary key: affected rows: %s' % rows)
 
 
@@ -0,0 +1,190 @@
+'''
+Adaptive connection pool manager around aiomysql.Pool.
+
+aiomysql gives us a pool with fixed bounds, the manager adds:
+- warm_up(): open connections in parallel before the server accepts traffic
+- autoscaling: raise / lower the pool's maxsize between maxsize and max_limit,
+  driven by the acquire wait that orm reports through observe() and by utilization
+- health checks: idle connections are pinged in the background, broken ones,
+  ones older than max_age and surplus idle ones (above minsize) are closed
+
+aiomysql has no public API to resize or inspect free connections, so the
+manager works on Pool._free / _used / _cond / _closing / _conn_kwargs. The pool's maxsize is
+the maxlen of the _free deque: resizing rebuilds it, and nothing may be appended
+to a full _free, since a full deque silently drops (and leaks) its oldest connection.
+Keep that in mind when upgrading aiomysql.
+'''
+
+import asyncio, collections, logging, time, weakref
+import aiomysql
+
+
+class PoolManager(object):
+    '''
+    Usage (see orm.create_pool):
+
+        pool = await aiomysql.create_pool(...)
+        manager = PoolManager(pool, minsize=1, maxsize=10, max_limit=50)
+        await manager.warm_up()
+        manager.start()
+        ...
+        await manager.close()
+    '''
+
+    def __init__(self, pool, minsize=1, maxsize=10, max_limit=50, warm=None,
+                 max_age=3600, idle_timeout=300, ping_interval=30,
+                 scale_interval=10, wait_threshold=0.01, high_usage=0.8, low_usage=0.3):
+        self.pool = pool
+        self.minsize = minsize
+        self.maxsize = maxsize                 # lower bound of the autoscaled maxsize
+        self.max_limit = max(max_limit, maxsize) # upper bound of the autoscaled maxsize
+        self.warm = maxsize if warm is None else min(warm, maxsize)
+        self.max_age = max_age                 # seconds, recycle connections older than this
+        self.idle_timeout = idle_timeout       # seconds, close idle connections above minsize
+        self.ping_interval = ping_interval     # seconds, ping connections idle longer than this
+        self.scale_interval = scale_interval   # seconds between autoscale decisions
+        self.wait_threshold = wait_threshold   # seconds, average acquire wait that triggers growth
+        self.high_usage = high_usage
+        self.low_usage = low_usage
+        self._born = weakref.WeakKeyDictionary() # conn -> time it was opened
+        self._waits = []
+        self._peak_usage = 0.0
+        self._tasks = []
+        # the pool was just created, its minsize connections were opened now
+        now = time.time()
+        for conn in pool._free:
+            self._born[conn] = now
+
+    @property
+    def usage(self):
+        # fraction of the current maxsize handed out to requests
+        return len(self.pool._used) / self.pool.maxsize
+
+    def observe(self, wait, conn):
+        ' called by orm with the seconds spent waiting in pool.acquire() and the connection it got. '
+        # the manager opens the minsize and warm connections itself; aiomysql only opens one
+        # in acquire() when _free is empty and hands it out at once, so now is its opening time
+        self._born.setdefault(conn, time.time())
+        self._waits.append(wait)
+        self._peak_usage = max(self._peak_usage, self.usage)
+
+    async def warm_up(self):
+        # open connections until the pool holds self.warm of them
+        t0 = time.perf_counter()
+        await self._open(self.warm - self.pool.size)
+        logging.info('pool warmed up: %s connections in %.1f ms' % (self.pool.size, (time.perf_counter() - t0) * 1000))
+
+    async def _open(self, n):
+        # pool.acquire() opens connections one at a time while holding pool._cond, so
+        # every acquire waits for each handshake. Open n of them in parallel outside
+        # the lock, with the pool's own settings, and hand them to the pool.
+        pool = self.pool
+        if n <= 0:
+            return
+        results = await asyncio.gather(*[aiomysql.connect(echo=pool._echo, loop=pool._loop, **pool._conn_kwargs) for _ in range(n)], return_exceptions=True)
+        now = time.time()
+        for conn in results:
+            if isinstance(conn, BaseException):
+                logging.warning('pool: connect failed: %s' % conn)
+            elif pool._closing or pool.size >= pool.maxsize:
+                # acquire() opened some meanwhile, or the pool is closing
+                conn.close()
+            else:
+                self._born[conn] = now
+                pool._free.append(conn)
+        async with pool._cond:
+            pool._cond.notify_all()
+
+    def start(self):
+        self._tasks = [
+            asyncio.ensure_future(self._every(self.scale_interval, self.autoscale)),
+            asyncio.ensure_future(self._every(self.ping_interval, self.check_idle))
+        ]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.pool.close()
+        await self.pool.wait_closed()
+
+    async def _every(self, interval, fn):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await fn()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('pool manager: %s failed' % fn.__name__)
+
+    async def autoscale(self):
+        waits, self._waits = self._waits, []
+        peak, self._peak_usage = max(self._peak_usage, self.usage), 0.0
+        avg_wait = sum(waits) / len(waits) if waits else 0.0
+        old = self.pool.maxsize
+        if avg_wait > self.wait_threshold or peak >= self.high_usage:
+            new = min(self.max_limit, old * 2)
+        elif peak < self.low_usage:
+            new = max(self.maxsize, old - max(1, old // 4))
+            # close idle connections first; connections in use still count, so never go
+            # below pool.size, or their release() would overflow _free. The next ticks
+            # keep shrinking as they come back.
+            self._trim(self.pool.size - new)
+            new = max(new, self.pool.size)
+        else:
+            return
+        if new == old:
+            return
+        logging.info('pool maxsize %s -> %s (avg wait %.1f ms, peak usage %.0f%%)' % (old, new, avg_wait * 1000, peak * 100))
+        self.pool._free = collections.deque(self.pool._free, maxlen=new)
+        # waiters blocked on a full pool may now open a connection
+        async with self.pool._cond:
+            self.pool._cond.notify_all()
+
+    async def check_idle(self):
+        # check the idle connections one by one; the others stay in _free meanwhile,
+        # so pool.size is at most one short while a ping is in flight
+        pool = self.pool
+        loop = asyncio.get_event_loop()
+        closed = 0
+        for conn in list(pool._free):
+            if conn not in pool._free:
+                # handed out or closed since the snapshot
+                continue
+            now = time.time()
+            born = self._born.setdefault(conn, now)
+            idle = loop.time() - conn.last_usage
+            if conn.closed or now - born > self.max_age or (idle > self.idle_timeout and pool.size > self.minsize):
+                pool._free.remove(conn)
+                conn.close()
+                closed += 1
+            elif idle > self.ping_interval:
+                pool._free.remove(conn)
+                try:
+                    await conn.ping(False)
+                except Exception as e:
+                    logging.warning('pool: dropping broken connection: %s' % e)
+                    conn.close()
+                    closed += 1
+                    continue
+                except BaseException:
+                    # cancelled by close(): the connection is in neither _free nor _used
+                    conn.close()
+                    raise
+                if pool._closing or pool.size >= pool.maxsize:
+                    # the pool refilled or was closed while we pinged
+                    conn.close()
+                else:
+                    pool._free.append(conn)
+        if closed:
+            logging.info('pool: closed %s stale connections, %s idle' % (closed, len(pool._free)))
+        # replace what was closed, back up to minsize, without holding pool._cond
+        await self._open(self.minsize - pool.size)
+
+    def _trim(self, n):
+        # close up to n idle connections
+        while n > 0 and self.pool._free:
+            self.pool._free.popleft().close()
+            n -= 1
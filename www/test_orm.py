@@ -0,0 +1,81 @@
+'''
+Tests for the counter statements built by Model.save / update / remove (Comment -> Blog.comment_count).
+'''
+
+import asyncio, unittest
+
+import orm
+from models import Blog, Comment
+
+
+class FakeTransaction(object):
+    # records (sql, args), select returns the rows given to it
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = []
+
+    async def select(self, sql, args):
+        self.statements.append((sql, args))
+        return self.rows
+
+    async def execute(self, sql, args):
+        self.statements.append((sql, args))
+        return 1
+
+
+BUMP = 'update `blogs` set `comment_count`=`comment_count`+? where `id`=?'
+BUMP_BY_COMMENT = 'update `blogs` set `comment_count`=`comment_count`+? where `id`=(select `blog_id` from `comments` where `id`=?)'
+
+
+class TestCounters(unittest.TestCase):
+
+    def setUp(self):
+        self._transaction = orm.transaction
+
+    def tearDown(self):
+        orm.transaction = self._transaction
+
+    def run_tx(self, coro, rows=()):
+        tx = FakeTransaction(list(rows))
+        async def transaction(fn):
+            return await fn(tx)
+        orm.transaction = transaction
+        asyncio.run(coro)
+        return tx.statements
+
+    def comment(self, blog_id='b1'):
+        return Comment(id='c1', blog_id=blog_id, user_id='u1', user_name='n', user_image='i', content='x', created_at=1.0)
+
+    def test_fields_are_not_class_attributes(self):
+        self.assertFalse(hasattr(Comment, 'blog_id'))
+        self.assertIsNone(Comment(id='c1').getValue('blog_id'))
+
+    def test_save(self):
+        statements = self.run_tx(self.comment().save())
+        self.assertEqual(statements[0][0], Comment.__insert__)
+        self.assertEqual(statements[1:], [(BUMP, [1, 'b1'])])
+
+    def test_update_same_blog(self):
+        statements = self.run_tx(self.comment().update(), [{'blog_id': 'b1'}])
+        self.assertEqual(statements[0], ('select `blog_id` from `comments` where `id`=? for update', ['c1']))
+        self.assertEqual([sql for sql, _ in statements[1:]], [Comment.__update__])
+
+    def test_update_moves_blog(self):
+        statements = self.run_tx(self.comment('b2').update(), [{'blog_id': 'b1'}])
+        self.assertEqual(statements[1], (BUMP, [-1, 'b1']))
+        self.assertEqual(statements[2][0], Comment.__update__)
+        self.assertEqual(statements[3], (BUMP, [1, 'b2']))
+
+    def test_remove(self):
+        # a stale blog_id in memory does not matter, the database row decides
+        statements = self.run_tx(self.comment('stale').remove())
+        self.assertEqual(statements, [(BUMP_BY_COMMENT, [-1, 'c1']), (Comment.__delete__, ['c1'])])
+
+    def test_blog_update_skips_counter(self):
+        self.assertNotIn('comment_count', Blog.__update__)
+        self.assertNotIn('comment_count', Blog.__update_fields__)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+'''
+Tests for pool.PoolManager on a real aiomysql.Pool, with aiomysql.connect replaced by fake connections.
+'''
+
+import asyncio, time, unittest
+
+import aiomysql
+import pool
+
+
+class FakeReader(object):
+    eof_received = False
+
+    def at_eof(self):
+        return False
+
+    def exception(self):
+        return None
+
+
+class FakeConnection(object):
+    # what aiomysql.Pool and PoolManager use of a Connection
+
+    opened = []
+
+    def __init__(self, ping_delay=0.0):
+        self._reader = FakeReader()
+        self.closed = False
+        self.last_usage = asyncio.get_event_loop().time()
+        self.ping_delay = ping_delay
+        FakeConnection.opened.append(self)
+
+    def close(self):
+        self.closed = True
+
+    def get_transaction_status(self):
+        return False
+
+    async def ping(self, reconnect=True):
+        await asyncio.sleep(self.ping_delay)
+
+
+async def fake_connect(**kw):
+    await asyncio.sleep(0.05) # handshake
+    return FakeConnection()
+
+
+class TestPoolManager(unittest.TestCase):
+
+    def setUp(self):
+        self._connect = aiomysql.connect
+        # PoolManager calls aiomysql.connect, the pool its own import of it
+        aiomysql.connect = aiomysql.pool.connect = fake_connect
+        FakeConnection.opened = []
+
+    def tearDown(self):
+        aiomysql.connect = aiomysql.pool.connect = self._connect
+
+    def run_with_pool(self, test, **kw):
+        async def go():
+            p = await aiomysql.create_pool(minsize=0, maxsize=4, host='db', user='u', password='p', db='d')
+            await test(p, pool.PoolManager(p, **kw))
+        asyncio.run(go())
+
+    def assertNoLeak(self, p):
+        # every open connection is known to the pool
+        alive = [c for c in FakeConnection.opened if not c.closed]
+        self.assertEqual(sorted(map(id, alive)), sorted(map(id, list(p._free) + list(p._used))))
+
+    def test_warm_up_in_parallel(self):
+        async def test(p, m):
+            t = time.perf_counter()
+            await m.warm_up()
+            self.assertLess(time.perf_counter() - t, 0.15)
+            self.assertEqual(p.size, 4)
+            self.assertEqual(len(m._born), 4)
+        self.run_with_pool(test, maxsize=4)
+
+    def test_autoscale_resizes_pool(self):
+        async def test(p, m):
+            await m.warm_up()
+            conns = [await p.acquire() for _ in range(4)]
+            for c in conns:
+                m.observe(0.0, c)
+            await m.autoscale()
+            self.assertEqual(p.maxsize, 8)
+            extra = [await p.acquire() for _ in range(4)]
+            self.assertEqual(p.size, 8)
+            # idle pool: shrink, never below the connections still open
+            for c in conns + extra[1:]:
+                p.release(c)
+            await m.autoscale()
+            self.assertEqual(p.maxsize, 6)
+            self.assertEqual(p.size, 6)
+            await m.autoscale()
+            await m.autoscale()
+            self.assertEqual(p.maxsize, 4)
+            p.release(extra[0])
+            self.assertNoLeak(p)
+        self.run_with_pool(test, maxsize=4, max_limit=8)
+
+    def test_check_idle_refills_to_minsize(self):
+        async def test(p, m):
+            await m.warm_up()
+            p._free[0].closed = True
+            await m.check_idle()
+            self.assertEqual(p.size, 2)
+            self.assertNoLeak(p)
+        self.run_with_pool(test, minsize=2, maxsize=4, warm=2)
+
+    def test_cancelled_ping_closes_connection(self):
+        async def test(p, m):
+            await m.warm_up()
+            conn = p._free[0]
+            conn.last_usage -= 60
+            conn.ping_delay = 10
+            task = asyncio.ensure_future(m.check_idle())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertTrue(conn.closed)
+            self.assertNoLeak(p)
+        self.run_with_pool(test, maxsize=4, warm=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
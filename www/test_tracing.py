@@ -0,0 +1,56 @@
+'''
+Tests for tracing: a request served by app.create_app() carries the Server-Timing header.
+'''
+
+import asyncio, unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer, TestClient
+
+import app, tracing
+
+
+async def _get(path, extra_routes=()):
+    a = app.create_app()
+    for p, h in extra_routes:
+        a.router.add_get(p, h)
+    async with TestClient(TestServer(a)) as client:
+        resp = await client.get(path)
+        await resp.read()
+        return resp
+
+
+class TestServerTiming(unittest.TestCase):
+
+    def test_index_has_header(self):
+        resp = asyncio.run(_get('/'))
+        self.assertEqual(resp.status, 200)
+        self.assertIn('db;desc="0 queries"', resp.headers['Server-Timing'])
+
+    def test_queries_and_cpu(self):
+        seen = []
+
+        async def handler(request):
+            for i in range(tracing.N_PLUS_ONE_THRESHOLD):
+                tracing.record_query('select * from `comments` where `blog_id`=?', 0.002, 0.001, 3)
+            # waiting is not handler CPU
+            await asyncio.sleep(0.2)
+            seen.append(tracing.current_trace())
+            raise web.HTTPNotFound()
+
+        with self.assertLogs(level='WARNING') as logs:
+            resp = asyncio.run(_get('/q', [('/q', handler)]))
+        self.assertEqual(resp.status, 404)
+        header = resp.headers['Server-Timing']
+        self.assertIn('db;desc="5 queries";dur=10.0', header)
+        self.assertIn('pool;dur=5.0', header)
+        trace = seen[0]
+        self.assertEqual(trace.rows, 15)
+        self.assertGreaterEqual(trace.elapsed, 0.2)
+        self.assertLess(trace.cpu_time, 0.1)
+        self.assertTrue(any('possible N+1' in line for line in logs.output))
+        self.assertIsNone(tracing.current_trace())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+'''
+Per-request performance tracing.
+
+trace_middleware starts a RequestTrace for every request and keeps it in a
+contextvar, so orm.select / orm.execute can add to it without passing the
+request around. The finished trace is kept in request['__trace__'];
+on_response_prepare writes it as a Server-Timing header on whatever response
+is finally sent. Slow requests are (sampled) logged as JSON.
+Both are registered in app.create_app().
+'''
+
+import json, logging, random, time, heapq
+from contextvars import ContextVar
+
+from aiohttp import web
+
+# the same query shape repeated this many times in one request is reported as a likely N+1
+N_PLUS_ONE_THRESHOLD = 5
+# requests slower than this (ms) are candidates for the slow request log
+SLOW_REQUEST_MS = 500
+# fraction of slow requests actually written to the log
+SLOW_REQUEST_SAMPLE_RATE = 1.0
+# how many of the slowest requests are kept in memory, see slowest()
+SLOWEST_KEEP = 20
+
+_current_trace = ContextVar('request_trace', default=None)
+_slowest = [] # min-heap of (elapsed_ms, seq, trace dict)
+_seq = 0
+
+
+class RequestTrace(object):
+    '''
+    Totals collected while handling one request.
+
+    Attributes:
+    queries: number of SQL statements executed
+    db_time / pool_wait: seconds spent running queries / waiting for a pooled connection
+    rows: rows fetched by SELECT statements
+    cpu_time: CPU seconds spent running the handler itself, only its own steps on
+              the event loop are timed, so other requests running meanwhile are not counted
+    shapes: {sql: count}, sql still has '?' placeholders so it is the query shape
+    '''
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.queries = 0
+        self.db_time = 0.0
+        self.pool_wait = 0.0
+        self.rows = 0
+        self.cpu_time = 0.0
+        self.elapsed = 0.0
+        self.shapes = dict()
+        self._start = time.perf_counter()
+
+    def add_query(self, sql, db_time, pool_wait=0.0, rows=0):
+        self.queries += 1
+        self.db_time += db_time
+        self.pool_wait += pool_wait
+        self.rows += rows
+        self.shapes[sql] = self.shapes.get(sql, 0) + 1
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self._start
+
+    def repeated_queries(self, threshold=None):
+        # query shapes run at least `threshold` times: likely N+1
+        if threshold is None:
+            threshold = N_PLUS_ONE_THRESHOLD
+        return {sql: n for sql, n in self.shapes.items() if n >= threshold}
+
+    def server_timing(self):
+        # value for the Server-Timing response header, durations in ms
+        return ', '.join([
+            'db;desc="{} queries";dur={:.1f}'.format(self.queries, self.db_time * 1000),
+            'pool;dur={:.1f}'.format(self.pool_wait * 1000),
+            'cpu;dur={:.1f}'.format(self.cpu_time * 1000),
+            'total;dur={:.1f}'.format(self.elapsed * 1000),
+        ])
+
+    def to_dict(self):
+        return dict(
+            method=self.method,
+            path=self.path,
+            elapsed_ms=round(self.elapsed * 1000, 1),
+            cpu_ms=round(self.cpu_time * 1000, 1),
+            db_ms=round(self.db_time * 1000, 1),
+            pool_wait_ms=round(self.pool_wait * 1000, 1),
+            queries=self.queries,
+            rows=self.rows,
+            repeated=self.repeated_queries()
+        )
+
+
+class _Timed(object):
+    '''
+    Awaitable driving a coroutine step by step and adding the thread CPU time
+    of each step to trace.cpu_time. Between steps the task is suspended and
+    other tasks run, that time is not counted.
+    '''
+
+    def __init__(self, coro, trace):
+        self._coro = coro
+        self._trace = trace
+
+    def __await__(self):
+        it = self._coro.__await__()
+        value, exc = None, None
+        while True:
+            t = time.thread_time()
+            try:
+                if exc is None:
+                    future = it.send(value)
+                else:
+                    future = it.throw(exc)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self._trace.cpu_time += time.thread_time() - t
+            try:
+                value, exc = (yield future), None
+            except GeneratorExit:
+                it.close()
+                raise
+            except BaseException as e:
+                value, exc = None, e
+
+
+def current_trace():
+    ' the trace of the request being handled, or None outside a request. '
+    return _current_trace.get()
+
+def start_trace(method, path):
+    # return (trace, token), pass the token back to end_trace()
+    trace = RequestTrace(method, path)
+    return trace, _current_trace.set(trace)
+
+def end_trace(trace, token):
+    global _seq
+    _current_trace.reset(token)
+    trace.finish()
+    repeated = trace.repeated_queries()
+    for sql, n in repeated.items():
+        logging.warning('possible N+1 in {} {}: {} x {}'.format(trace.method, trace.path, n, sql))
+    elapsed_ms = trace.elapsed * 1000
+    if elapsed_ms < SLOW_REQUEST_MS:
+        return
+    record = trace.to_dict()
+    _seq += 1
+    if len(_slowest) < SLOWEST_KEEP:
+        heapq.heappush(_slowest, (elapsed_ms, _seq, record))
+    elif elapsed_ms > _slowest[0][0]:
+        heapq.heapreplace(_slowest, (elapsed_ms, _seq, record))
+    if random.random() < SLOW_REQUEST_SAMPLE_RATE:
+        logging.warning('slow request: {}'.format(json.dumps(record)))
+
+def record_query(sql, db_time, pool_wait=0.0, rows=0):
+    # called by orm for every statement, no-op outside a request
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_query(sql, db_time, pool_wait, rows)
+
+@web.middleware
+async def trace_middleware(request, handler):
+    # every route is traced, the handler runs with the trace in _current_trace
+    trace, token = start_trace(request.method, request.path)
+    try:
+        return await _Timed(handler(request), trace)
+    finally:
+        end_trace(trace, token)
+        request['__trace__'] = trace
+
+async def on_response_prepare(request, response):
+    # app.on_response_prepare hook: handlers returning dicts get the header too
+    trace = request.get('__trace__')
+    if trace is not None:
+        response.headers['Server-Timing'] = trace.server_timing()
+
+def slowest(n=None):
+    ' the slowest requests seen so far (at most SLOWEST_KEEP), slowest first. '
+    L = [r for _, _, r in sorted(_slowest, reverse=True)]
+    return L if n is None else L[:n]